@@ -3,19 +3,26 @@
 # Flickr API docs are here:
 # https://www.flickr.com/services/api/
 #
-# Python wrapper for WP XML-RPC API docs are here:
-# https://python-wordpress-xmlrpc.readthedocs.io/
+# WordPress REST API docs are here:
+# https://developer.wordpress.org/rest-api/reference/
+# We use it rather than XML-RPC, so media uploads are plain multipart
+# rather than base64 inside XML.
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import csv
 from datetime import datetime
-from itertools import chain
-import json
 import os
 import re
+import tempfile
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from urllib3.util.retry import Retry
 
 import flickrapi
+import orjson
 
 from dynaconf import Dynaconf
 
@@ -25,56 +32,160 @@ settings = Dynaconf(
     load_dotenv=True,
 )
 
+def retrying_adapter(pool_connections, pool_maxsize, allowed_methods=('GET',)):
+    """
+    A connection-pooling adapter which quietly retries, with backoff,
+    when Flickr or WordPress have a transient problem.
+    Only pass methods in allowed_methods which are safe to repeat.
+    """
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=allowed_methods
+    )
+    return HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+
 def wp_rest_url(method):
     return f"{settings.wordpress_url}/wp-json/wp/v2/{method}"
 
 def get_wp():
     wp = requests.Session()
     wp.auth = (settings.wordpress_username, settings.wordpress_password)
+    # Keep one connection alive per upload thread, so they never queue
+    # for a socket or reconnect.
+    wp.mount("https://", retrying_adapter(pool_connections=1, pool_maxsize=settings.get("wordpress_upload_workers", 4)))
+    # Updating a post just sets its content, so doing it twice is harmless.
+    # Media uploads are not retried: a gateway error can arrive after
+    # WordPress has already stored the file, and retrying would duplicate it.
+    wp.mount(wp_rest_url("posts"), retrying_adapter(pool_connections=1, pool_maxsize=1, allowed_methods=('GET', 'POST')))
     return wp
 
+def get_downloader(download_workers):
+    """
+    A session for image downloads, so that we keep connections to the
+    Flickr static servers alive between photos, one per download thread.
+    """
+    downloader = requests.Session()
+    downloader.mount("https://", retrying_adapter(pool_connections=10, pool_maxsize=download_workers))
+    return downloader
+
 def get_flickr():
     return flickrapi.FlickrAPI(settings.flickr_api_key, settings.flickr_api_secret, format='parsed-json')
 
 # How will we recognise a flickr URL?
 flickr_photo_re = re.compile(r'(https?://(?:www\.)?flickr\.com/photos/quentinsf/(\d{9,11})/?)[/"]')
 flickr_farm_photo_re = re.compile(r'(https?://(?:farm\d+\.)?static\.?flickr\.com/\d+/(\d+)_[^"]*\.jpg)"')
+# Both of the above in one pattern, so each post is scanned only once,
+# also noting whether the URL is in an href or a src attribute.
+# Group 1 is the attribute; 2 and 3 the page URL and id; 4 and 5 the farm URL and id.
+flickr_url_re = re.compile(f'(?:(href|src)=")?(?:{flickr_photo_re.pattern}|{flickr_farm_photo_re.pattern})')
 
-def post_retriever(wp, offset=0):
-    increment = 50
-    while True:
-        resp = wp.get(wp_rest_url("posts"), params = {
-            "offset": offset,
-            "per_page": increment
+def write_cache_file(path, data):
+    """
+    Save data as JSON under a temporary name first, so an interrupted
+    run can't leave a truncated cache file behind.
+    """
+    with tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(path), delete=False) as f:
+        f.write(orjson.dumps(data))
+    os.replace(f.name, path)
+
+def get_posts_page(wp, offset, per_page, search=None):
+    """
+    Get one page of posts, optionally only those which WordPress finds
+    when searching for the given text.  If we've fetched this page before
+    and WordPress gave us an ETag or Last-Modified header, ask whether it
+    has changed, and use our saved copy if not.
+    """
+    params = {
+        "offset": offset,
+        "per_page": per_page
+    }
+    if search:
+        params["search"] = search
+    path = os.path.join(settings.get("wordpress_cache_dir", "./cache/wordpress"), f"posts_{search or 'all'}_{offset}_{per_page}.json")
+    cached = None
+    headers = {}
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            cached = orjson.loads(f.read())
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+    resp = wp.get(wp_rest_url("posts"), headers=headers, params=params, timeout=60)
+    if resp.status_code == 304 and cached:
+        return cached['posts']
+    posts = resp.json()
+    etag = resp.headers.get('ETag')
+    last_modified = resp.headers.get('Last-Modified')
+    if etag or last_modified:
+        write_cache_file(path, {
+            "etag": etag,
+            "last_modified": last_modified,
+            "posts": posts
         })
-        posts = resp.json()
-        if len(posts) == 0:
-            break  # no more posts returned
-        for post in posts:
-            yield post
-        offset = offset + increment
+    return posts
+
+def post_retriever(wp, offset=0, search=None):
+    increment = 100  # the most the WP REST API will give us at once
+    os.makedirs(settings.get("wordpress_cache_dir", "./cache/wordpress"), exist_ok=True)
+    # Ask for the next page while the caller is working through this one.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_page = executor.submit(get_posts_page, wp, offset, increment, search)
+        while True:
+            posts = next_page.result()
+            if len(posts) == 0:
+                break  # no more posts returned
+            offset = offset + increment
+            next_page = executor.submit(get_posts_page, wp, offset, increment, search)
+            for post in posts:
+                yield post
+
+def read_catalog(filename):
+    """
+    Read a catalog written by write_catalog, in either of its formats.
+    """
+    with open(filename, "rb") as catalog:
+        first = catalog.read(1)
+        catalog.seek(0)
+        if first == b"[":
+            return orjson.loads(catalog.read())
+        # Compact catalogs have one JSON record per line.
+        return [orjson.loads(line) for line in catalog if line.strip()]
+
+def write_catalog(filename, items):
+    """
+    Write a catalog as an indented JSON list, or, if the compact_catalogs
+    setting is on, as one JSON record per line, which is much smaller and
+    quicker to write and read back for large catalogs.
+    """
+    with open(filename, "wb") as output:
+        if settings.get("compact_catalogs", False):
+            for item in items:
+                output.write(orjson.dumps(item))
+                output.write(b"\n")
+        else:
+            output.write(orjson.dumps(items, option=orjson.OPT_INDENT_2))
 
 def read_post_catalog(filename):
-    with open(filename, "r") as post_catalog: 
-        print("Reading posts from", filename)
-        posts = json.load(post_catalog)
-    return posts
+    print("Reading posts from", filename)
+    return read_catalog(filename)
 
 def write_post_catalog(filename, posts):
-    with open(filename, "w") as output:
-        print(f"Writing {len(posts)} posts to {filename}")
-        json.dump(posts, output, indent=2)
+    print(f"Writing {len(posts)} posts to {filename}")
+    write_catalog(filename, posts)
 
-def catalog_posts(args):
+def find_posts(wp, offset=0, limit=0):
     """
     Get a list of posts with flickr.com URLs in them.
     """
-    arg_dict = vars(args)
-    wp = get_wp()
     count = 0
-    limit = arg_dict.get('limit', 0)
     posts = []
-    for post in post_retriever(wp, arg_dict.get('offset', 0)):
+    # Let WordPress do the first round of filtering, so we aren't sent
+    # posts we'll only throw away.  Its search also looks at titles and
+    # excerpts, so we still check the content ourselves.
+    for post in post_retriever(wp, offset, search="flickr.com"):
         content =  post['content']['rendered']
         if "flickr.com" in content:
             print(post['id'], post['title']['rendered'], post['link'])
@@ -82,202 +193,421 @@ def catalog_posts(args):
             count += 1
             if limit and count >= limit:
                 break
+    return posts
+
+def catalog_posts(args):
+    arg_dict = vars(args)
+    posts = find_posts(get_wp(), arg_dict.get('offset', 0), arg_dict.get('limit', 0))
     write_post_catalog(args.output, posts)
 
-def process_posts(args):
+def find_flickr_urls(posts):
     """
     Build up information about URLs in post contents which match our regexes.
-    Augment the post catalog with this information.
+    Augment the posts with this information.
     """
-    posts = read_post_catalog(args.post_catalog)
     print(len(posts), "posts to process")
     for post in posts:
         flickr_images = []
+        post['flickr_images'] = flickr_images
         content =  post['content']['rendered']
-        for match in chain(
-            flickr_photo_re.finditer(content), 
-            flickr_farm_photo_re.finditer(content)
-        ):
+        for match in flickr_url_re.finditer(content):
+            url_group = 2 if match.group(2) else 4
             img_info = {
-                "flickr_id": match.group(2),
-                "url": match.group(1),
-                "url_start": match.start(1),
-                "url_end": match.end(1)
+                "flickr_id": match.group(url_group + 1),
+                "url": match.group(url_group),
+                "url_start": match.start(url_group),
+                "url_end": match.end(url_group),
+                "kind": match.group(1)
             }
             print(f"   {img_info['flickr_id']} at {img_info['url']}")
             flickr_images.append(img_info)
-        post['flickr_images'] = flickr_images
+    return posts
+
+def process_posts(args):
+    posts = read_post_catalog(args.post_catalog)
+    find_flickr_urls(posts)
     write_post_catalog(args.output, posts)
 
 
 def read_image_catalog(filename):
-    with open(filename, "r") as image_catalog: 
-        print("Reading images from", filename)
-        images = json.load(image_catalog)
-    return images
+    print("Reading images from", filename)
+    return read_catalog(filename)
 
 def write_image_catalog(filename, images):
-    with open(filename, "w") as output:
-        print(f"Writing {len(images)} images to {filename}")
-        json.dump(images, output, indent=2)
+    print(f"Writing {len(images)} images to {filename}")
+    write_catalog(filename, images)
+
+# Photo-list extras which give us the URLs for the sizes we use,
+# and the getSizes labels they correspond to.
+flickr_size_extras = {
+    'url_o': 'Original',
+    'url_c': 'Medium 800',
+    'url_z': 'Medium 640',
+    'url_m': 'Medium',
+}
+
+def photostream_sizes(flickr):
+    """
+    Page through the user's public photos once, asking for the image URLs
+    as extras, and return a dict keyed by photo id of sizes in the same
+    shape that getSizes would give us.
+    """
+    user = flickr.urls.lookupUser(url=f"https://www.flickr.com/photos/{settings.flickr_user_id}/")
+    user_id = user['user']['id']
+    print("Fetching photo list for", user_id)
+    all_sizes = {}
+    page = 1
+    while True:
+        resp = flickr.people.getPublicPhotos(
+            user_id=user_id,
+            extras=",".join(flickr_size_extras),
+            per_page=500,
+            page=page
+        )
+        for photo in resp['photos']['photo']:
+            all_sizes[photo['id']] = {
+                label: {'label': label, 'source': photo[extra]}
+                for extra, label in flickr_size_extras.items() if extra in photo
+            }
+        if page >= int(resp['photos']['pages']):
+            break
+        page += 1
+    print(f"  {len(all_sizes)} photos listed")
+    return all_sizes
 
-def catalog_images(args):
-    posts = read_post_catalog(args.post_catalog)
+def cached_flickr_call(cache_name, fetch):
+    """
+    Return our local copy of a Flickr answer if we've asked before,
+    otherwise call fetch() and keep what it returns for next time.
+    """
+    path = os.path.join(settings.get("flickr_cache_dir", "./cache/flickr"), cache_name)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    data = fetch()
+    write_cache_file(path, data)
+    return data
+
+def cached_sizes(flickr, flickr_id):
+    """
+    Get the list of sizes for a photo, using our local copy if we've
+    asked Flickr about it before.
+    """
+    return cached_flickr_call(
+        f"{flickr_id}.json",
+        lambda: flickr.photos.getSizes(photo_id=flickr_id)['sizes']['size']
+    )
+
+def cached_info(flickr, flickr_id):
+    """
+    Get the full details of a photo, using our local copy if we've
+    asked Flickr about it before.
+    """
+    return cached_flickr_call(
+        f"{flickr_id}_info.json",
+        lambda: flickr.photos.getInfo(photo_id=flickr_id)
+    )
+
+def get_image_info(posts, fetch_info=False, from_photostream=False):
+    """
+    Find the available sizes of each Flickr photo used in the posts.
+    Only the sizes are used later, so we don't ask Flickr for anything else
+    unless fetch_info is set.
+    """
     print(len(posts), "posts to process")
 
     flickr = get_flickr()
-    photos = []
+    os.makedirs(settings.get("flickr_cache_dir", "./cache/flickr"), exist_ok=True)
+    known_sizes = photostream_sizes(flickr) if from_photostream else {}
+
+    def fetch_one(flickr_id):
+        try:
+            if fetch_info:
+                flickr_info = cached_info(flickr, flickr_id)
+            else:
+                flickr_info = {'photo': {'id': flickr_id}}
+            if flickr_id in known_sizes:
+                flickr_info['sizes'] = known_sizes[flickr_id]
+            else:
+                size_info = cached_sizes(flickr, flickr_id)
+                flickr_info['sizes'] = { s['label']: s  for s in size_info}
+            return flickr_info
+        except flickrapi.exceptions.FlickrError as e:
+            print(f"  Error trying to get info from Flickr for {flickr_id}:", e)
+            return None
+
+    # A photo may appear in several posts, but we only need to ask about
+    # it once.  A dict keeps them in the order we first saw them.
+    ids = {}
     for post in posts:
         print(post['id'], post['title']['rendered'], post['link'])
         for image_info in post['flickr_images']:
-            flickr_id = image_info['flickr_id']
-            print("  ", flickr_id)
-            try:
-                flickr_info = flickr.photos.getInfo(photo_id=flickr_id)            # print("  F:", flickr_info)
+            print("  ", image_info['flickr_id'])
+            ids[image_info['flickr_id']] = None
 
-                size_info = flickr.photos.getSizes(photo_id=flickr_id)['sizes']['size']
-                sizes = { s['label']: s  for s in size_info}
-                flickr_info['sizes'] = sizes
-                photos.append(flickr_info)
-            except flickrapi.exceptions.FlickrError as e:
-                print("  Error trying to get info from Flickr:", e)
+    # Each photo costs a slow Flickr API call, so have
+    # several photos in flight at once.
+    with ThreadPoolExecutor(max_workers=settings.get("flickr_api_workers", 8)) as executor:
+        photos = [info for info in executor.map(fetch_one, ids) if info is not None]
+    return photos
 
+def catalog_images(args):
+    posts = read_post_catalog(args.post_catalog)
+    photos = get_image_info(posts, args.fetch_info, args.from_photostream)
     write_image_catalog(args.output, photos)
 
 
-
-def download_images(args):
+def fetch_images(photos):
     """
     Grab a medium and an original size.
     Don't download if already existing.
     """
-
-    photos = read_image_catalog(args.image_catalog)
     print(len(photos), "images to process")
+    # Dynaconf lookups aren't free, so only do these once.
+    download_dir = settings.download_dir
+    download_workers = settings.get("download_workers", 8)
+    downloader = get_downloader(download_workers)
 
-    flickr = get_flickr()
-    
     def download_size(url, filename):
-        os.makedirs(settings.download_dir, exist_ok=True)
-        path = os.path.join(settings.download_dir, filename)
-        if not os.path.exists(path):
-            with open(path, "wb") as f:
-                f.write(requests.get(url).content)
-        else:
-            print("    ", path, "exists")
-
-    def download_photo(flickr_id, sizes):
-        smaller_file = None
+        path = os.path.join(download_dir, filename)
+        print("    Downloading", path)
+        # Stream to disk rather than holding whole originals in memory,
+        # and only give the file its real name once it's complete, so an
+        # interrupted run doesn't leave a truncated file that looks done.
+        part_path = path + ".part"
+        try:
+            with downloader.get(url, stream=True, timeout=30) as r:
+                r.raise_for_status()
+                with open(part_path, "wb", buffering=1 << 20) as f:
+                    for chunk in r.iter_content(1 << 16):
+                        f.write(chunk)
+        except requests.exceptions.RequestException as e:
+            # e.g. a photo since deleted from Flickr - skip it rather than
+            # abandoning all the other downloads.
+            print(f"    Error trying to download {filename}:", e)
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return False
+        os.replace(part_path, path)
+        return True
+
+    def photo_sizes(flickr_id, sizes):
+        """
+        Work out which (url, filename) pairs we want for this photo.
+        """
+        wanted = []
         if 'Medium 800' in sizes:
-            smaller_file = f"{flickr_id}_800.jpg"
-            download_size(sizes['Medium 800']['source'], smaller_file)
+            wanted.append((sizes['Medium 800']['source'], f"{flickr_id}_800.jpg"))
         elif 'Medium 640' in sizes:
-            smaller_file = f"{flickr_id}_640.jpg"
-            download_size(sizes['Medium 640']['source'], smaller_file)
+            wanted.append((sizes['Medium 640']['source'], f"{flickr_id}_640.jpg"))
         elif 'Medium' in sizes:
-            smaller_file = f"{flickr_id}_medium.jpg"
-            download_size(sizes['Medium']['source'], smaller_file)
+            wanted.append((sizes['Medium']['source'], f"{flickr_id}_medium.jpg"))
         else:
             print("    No Medium 800 - options:", sizes)
-        original_file = f"{flickr_id}.jpg"
         if 'Original' in sizes:
-            download_size(sizes['Original']['source'], original_file)
-        return (original_file, smaller_file)
+            wanted.append((sizes['Original']['source'], f"{flickr_id}.jpg"))
+        return wanted
 
+    # The same photo may be used in several posts, so gather the
+    # files we need by name first and only consider each one once.
+    needed = {}
     for photo in photos:
         flickr_id = photo['photo']['id']
-        sizes = photo['sizes']
-        (original_file, smaller_file) = download_photo(flickr_id, sizes)
-
+        for url, filename in photo_sizes(flickr_id, photo['sizes']):
+            needed[filename] = url
+
+    # One directory listing tells us what we already have, rather
+    # than checking for each file separately.
+    os.makedirs(download_dir, exist_ok=True)
+    existing = {entry.name for entry in os.scandir(download_dir) if entry.is_file()}
+    pairs = []
+    for filename, url in needed.items():
+        if filename in existing:
+            print("    ", os.path.join(download_dir, filename), "exists")
+        else:
+            pairs.append((url, filename))
+
+    # The downloads are independent, so overlap them rather than waiting
+    # for each one in turn.
+    print(len(pairs), "files to download")
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        results = list(executor.map(lambda pair: download_size(*pair), pairs))
+    failed = [filename for (url, filename), ok in zip(pairs, results) if not ok]
+    if failed:
+        print(f"{len(failed)} files could not be downloaded:")
+        for filename in failed:
+            print("  ", filename)
 
-def upload_to_wp(args):
+def download_images(args):
+    photos = read_image_catalog(args.image_catalog)
+    fetch_images(photos)
+
+
+def read_excludes(filename):
+    print(f"Ignoring posts listed in the first column of {filename}")
+    with open(filename, "r") as f:
+        rdr = csv.reader(f)
+        ignore_posts = {int(row[0]) for row in rdr}
+    print(f"{len(ignore_posts)} posts ignored")
+    return ignore_posts
+
+def read_already_uploaded(filename):
+    if not os.path.exists(filename):
+        print(f"No existing mappings in {filename} yet")
+        return {}
+    print(f"Getting existing mappings from local file to remote URL from {filename}")
+    with open(filename, "r") as f:
+        rdr = csv.reader(f)
+        already_uploaded = {row[0]:row[1] for row in rdr}
+    print(f"{len(already_uploaded)} images already uploaded")
+    return already_uploaded
+
+def upload_images(wp, posts, ignore_posts, already_uploaded, already_uploaded_file=None):
     """
-    Upload and associate images with the posts, but don't chenge the text yet.
-    Warning:  this overwrites the post catalog, so if you use 'limit', you will
-    truncate it unless you specify a new_post_catalog setting.
+    Upload and associate images with the posts, but don't change the text yet.
+    Each post's upload_info is filled in as its uploads finish, so whatever
+    did get uploaded is recorded even if a later upload fails.
+    New uploads are also added to already_uploaded and appended to
+    already_uploaded_file, so that neither this run nor later ones will
+    upload the same file again.
     """
-    posts = read_post_catalog(args.post_catalog)
-    print(len(posts), "posts in catalog")
-    if args.limit:
-        print(f"Limiting action to {args.limit} posts")
-        posts = posts[:args.limit]
-
-    ignore_posts = {}
-    if args.excludes:
-        print(f"Ignoring posts listed in the first column of {args.excludes}")
-        with open(args.excludes, "r") as f:
-            rdr = csv.reader(f)
-            ignore_posts = {int(row[0]) for row in rdr}
-        print(f"{len(ignore_posts)} posts ignored")
-
-    already_uploaded = {}
-    if args.already_uploaded:
-        print(f"Getting existing mappings from local file to remote URL from {args.already_uploaded}")
-        with open(args.already_uploaded, "r") as f:
-            rdr = csv.reader(f)
-            already_uploaded = {row[0]:row[1] for row in rdr}
-        print(f"{len(already_uploaded)} images already uploaded")
-
-    wp = get_wp()
+    download_dir = settings.download_dir
+    record_lock = threading.Lock()
+
+    # If the file was edited by hand and its last line has no newline, our
+    # first row would be glued onto the end of it, so we add one first.
+    needs_newline = False
+    if already_uploaded_file and os.path.exists(already_uploaded_file) \
+            and os.path.getsize(already_uploaded_file) > 0:
+        with open(already_uploaded_file, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+
+    def record_upload(photo_file, attachment_url):
+        nonlocal needs_newline
+        with record_lock:
+            already_uploaded[photo_file] = attachment_url
+            if already_uploaded_file:
+                with open(already_uploaded_file, "a", newline="") as f:
+                    if needs_newline:
+                        f.write("\n")
+                        needs_newline = False
+                    csv.writer(f).writerow([photo_file, attachment_url])
 
     def upload_media(photo_file, dest_path, data):
-        local_path = os.path.join(settings.download_dir, photo_file)
+        local_path = os.path.join(download_dir, photo_file)
         print("Uploading", local_path, "to", dest_path)
-        with open(local_path, 'rb') as file:
+        with open(local_path, 'rb', buffering=1 << 20) as file:
+            # Stream the file from disk as it's sent, rather than building
+            # the whole multipart body in memory first.  The large buffer
+            # means few reads even though it's sent in small pieces.
+            # A streamed body can't be sent again, which is another reason
+            # the WP session never retries media uploads.
+            fields = { k: str(v) for k, v in data.items() }
+            fields['file'] = (photo_file, file, 'image/jpeg')
+            body = MultipartEncoder(fields=fields)
             response = wp.post(
                 wp_rest_url('media'),
-                data = data,
-                files={ 'file': (photo_file, file) }
+                data = body,
+                headers = { 'Content-Type': body.content_type },
+                timeout = 300
             )
             assert response.status_code == 201
         response_data = response.json()
         attachment_url = response_data['source_url']
         print("   to", attachment_url)
+        record_upload(photo_file, attachment_url)
         return attachment_url
 
+    # Posts sharing a photo may be uploading at the same moment, so each
+    # file gets its own lock around checking whether it's already been
+    # uploaded and uploading it if not.  Only one of them uploads it, and
+    # the rest wait and reuse its URL.
+    file_locks = {}
+
+    def upload_once(photo_file, data):
+        with record_lock:
+            file_lock = file_locks.setdefault(photo_file, threading.Lock())
+        with file_lock:
+            if photo_file in already_uploaded:
+                attachment_url = already_uploaded[photo_file]
+                print(f"    {photo_file} already uploaded at {attachment_url}")
+                return attachment_url
+            return upload_media(photo_file, photo_file, data)
+
+    def upload_pair(pair):
+        post, flickr_id = pair
+        photo_data = {
+            "post": post['id'],
+            "date": post['date'],
+            "date_gmt": post['date_gmt'],
+            "description": f"Flickr item {flickr_id}."
+        }
+        original_file = f"{flickr_id}.jpg"
+        medium_file = f"{flickr_id}_800.jpg"
+        for photo_file in (original_file, medium_file):
+            if photo_file not in already_uploaded \
+                    and not os.path.exists(os.path.join(download_dir, photo_file)):
+                # Probably failed to download; leave this one for a later run.
+                print(f"    {photo_file} not downloaded - skipping {flickr_id} for post {post['id']}")
+                return None
+        original_url = upload_once(original_file, photo_data)
+        medium_url = upload_once(medium_file, photo_data)
+        return {
+            "original_url": original_url,
+            "medium_url": medium_url
+        }
+
+    # Work out everything that still needs doing before we start,
+    # so the uploads themselves can overlap.
+    missing = []
     for post in posts:
+        if post['id'] in ignore_posts:
+            print(f"Post {post['id']} at {post['link']} ignored")
+            continue
         if 'upload_info' not in post:
             post['upload_info'] = {}
         print(f"Post {post['id']} at {post['link']} has these flickr ids:")
+        post_ids = set()
         for img_info in post['flickr_images']:
             flickr_id = img_info['flickr_id']
             print("  ", flickr_id)
             if flickr_id in post['upload_info']:
                 print("    Already uploaded")
-                continue
-            photo_data = {
-                "post": post['id'],
-                "date": post['date'],
-                "date_gmt": post['date_gmt'],
-                "description": f"Flickr item {flickr_id}."
-            }
-            original_file = f"{flickr_id}.jpg"
-            medium_file = f"{flickr_id}_800.jpg"
-            if original_file in already_uploaded:
-                original_url = already_uploaded[original_file]
-                print(f"    Already uploaded at {original_url}")
-            else:
-                original_url = upload_media(original_file, original_file, photo_data)
-            if medium_file in already_uploaded:
-                medium_url = already_uploaded[medium_file]
-                print(f"    Already uploaded at {medium_url}")
-            else:
-                medium_url = upload_media(medium_file, medium_file, photo_data)
-            post['upload_info'][flickr_id] = {
-                "original_url": original_url,
-                "medium_url": medium_url
-            }
-    write_post_catalog(args.new_post_catalog, posts)
-
+            elif flickr_id not in post_ids:
+                post_ids.add(flickr_id)
+                missing.append((post, flickr_id))
+
+    print(len(missing), "images to upload")
+    with ThreadPoolExecutor(max_workers=settings.get("wordpress_upload_workers", 4)) as executor:
+        for (post, flickr_id), upload_info in zip(missing, executor.map(upload_pair, missing)):
+            if upload_info is not None:
+                post['upload_info'][flickr_id] = upload_info
+    return posts
 
-def update_posts(args):
+def upload_to_wp(args):
+    """
+    Upload and associate images with the posts, but don't chenge the text yet.
+    Warning:  this overwrites the post catalog, so if you use 'limit', you will
+    truncate it unless you specify a new_post_catalog setting.
+    """
     posts = read_post_catalog(args.post_catalog)
     print(len(posts), "posts in catalog")
-
     if args.limit:
         print(f"Limiting action to {args.limit} posts")
         posts = posts[:args.limit]
 
+    ignore_posts = read_excludes(args.excludes) if args.excludes else set()
+    already_uploaded = read_already_uploaded(args.already_uploaded) if args.already_uploaded else {}
+
+    # Record whatever did get uploaded, even if one of the uploads fails.
+    try:
+        upload_images(get_wp(), posts, ignore_posts, already_uploaded, args.already_uploaded)
+    finally:
+        write_post_catalog(args.new_post_catalog, posts)
+
+
+def confirm_update():
     confirmation = input("""
         This will replace the text of posts on your site!
         
@@ -285,46 +615,111 @@ def update_posts(args):
         and are happy to proceed: """)
     if confirmation != "YES":
         print("Aborting")
-        return
-    
-    wp = get_wp()
+        return False
+    return True
 
+def replace_urls(wp, posts):
+    """
+    Change the Flickr URLs in the posts to point at the uploaded copies,
+    and save any posts which changed back to WordPress.
+    """
     for post in posts:
         print(f"\nPost {post['id']}: {post['title']['rendered']} at {post['link']}")
         content = post['content']['rendered']
         # print("Currently:")
         # print(content)
-        new_content = content
-        # We want to do the last URL first, so we don't mess up the positions of the others.
-        flickr_images = sorted(post['flickr_images'], key=lambda x: x['url_start'], reverse=True)
+        # Rebuild the content from left to right in one pass, rather than
+        # copying the whole thing for each URL we replace.
+        parts = []
+        cursor = 0
+        flickr_images = sorted(post['flickr_images'], key=lambda x: x['url_start'])
         for img in flickr_images:
             fid = img["flickr_id"]
             url = img["url"]
             url_start = img["url_start"]
             url_end = img["url_end"]
             print(f"  {fid} at {url}")
-            try:
+            kind = img.get("kind")
+            if "kind" not in img:
+                # Catalogs written before process_posts recorded this.
                 if content[url_start-6:url_start] == 'href="':
+                    kind = "href"
+                elif content[url_start-5:url_start] == 'src="':
+                    kind = "src"
+            try:
+                if kind == "href":
                     print("    Looks like a link - using full-size image URL")
                     new_url = post['upload_info'][fid]['original_url']
-                elif content[url_start-5:url_start] == 'src="':
+                elif kind == "src":
                     print("    Looks like an image - using medium image URL")
                     new_url = post['upload_info'][fid]['medium_url']
                 else:
                     print("    Not sure what this is - using medium image URL")
                     new_url = post['upload_info'][fid]['medium_url']
-                new_content = new_content[:url_start] + new_url + new_content[url_end:]
             except KeyError:
                 print(f"    No upload info for {fid}")
+                new_url = content[url_start:url_end]
+            parts.append(content[cursor:url_start])
+            parts.append(new_url)
+            cursor = url_end
+        parts.append(content[cursor:])
+        new_content = "".join(parts)
 
         # print("Updated:")
         # print(new_content)
         if new_content != content:
             print("  Updating post")
             post['content']['rendered'] = new_content
-            wp.post(wp_rest_url(f"posts/{post['id']}"), data = {
+            wp.post(wp_rest_url(f"posts/{post['id']}"), timeout=60, data = {
                 'content': new_content
             })
+    return posts
+
+def update_posts(args):
+    posts = read_post_catalog(args.post_catalog)
+    print(len(posts), "posts in catalog")
+
+    if args.limit:
+        print(f"Limiting action to {args.limit} posts")
+        posts = posts[:args.limit]
+
+    if not confirm_update():
+        return
+    
+    replace_urls(get_wp(), posts)
+
+def run_all(args):
+    """
+    Do all of the above in one go, keeping the catalogs in memory rather
+    than reading and writing them between each stage.  With --checkpoint,
+    the catalogs are also written out after each stage, so that the
+    individual subcommands can pick up from there if something goes wrong.
+    """
+    if not confirm_update():
+        return
+
+    wp = get_wp()
+    ignore_posts = read_excludes(args.excludes) if args.excludes else set()
+    already_uploaded = read_already_uploaded(args.already_uploaded) if args.already_uploaded else {}
+
+    posts = find_posts(wp, args.offset, args.limit)
+    find_flickr_urls(posts)
+    if args.checkpoint:
+        write_post_catalog(args.post_catalog, posts)
+
+    photos = get_image_info(posts, args.fetch_info, args.from_photostream)
+    if args.checkpoint:
+        write_image_catalog(args.image_catalog, photos)
+
+    fetch_images(photos)
+
+    try:
+        upload_images(wp, posts, ignore_posts, already_uploaded, args.already_uploaded)
+    finally:
+        if args.checkpoint:
+            write_post_catalog(args.post_catalog, posts)
+
+    replace_urls(wp, posts)
 
 
 
@@ -348,6 +743,8 @@ def main():
     parser_catalog_images = subparsers.add_parser('catalog_images', help="Get the details of images to be downloaded for the posts")
     parser_catalog_images.add_argument('--post_catalog', type=str, default="posts.json", help="Post catalog file to read, default '%(default)s'")
     parser_catalog_images.add_argument('--output', type=str, default="images.json", help="Output image catalog file, default '%(default)s'")
+    parser_catalog_images.add_argument('--fetch_info', action='store_true', help="Also record each photo's title, description etc. from Flickr.")
+    parser_catalog_images.add_argument('--from_photostream', action='store_true', help="List the whole photostream once instead of asking about each photo.")
     parser_catalog_images.set_defaults(func=catalog_images)
 
     parser_download_images = subparsers.add_parser('download_images', help="Get images referred to in image catalog.")
@@ -368,6 +765,18 @@ def main():
     parser_update_posts.add_argument('--limit', type=int, help="Stop after this many posts.")
     parser_update_posts.set_defaults(func=update_posts)
 
+    parser_run_all = subparsers.add_parser('run_all', help="Do all of the above in one go. CHECK YOUR BACKUPS FIRST!")
+    parser_run_all.add_argument('--offset', type=int, default=0)
+    parser_run_all.add_argument('--limit', type=int, help="Stop after finding this many posts.")
+    parser_run_all.add_argument('--fetch_info', action='store_true', help="Also record each photo's title, description etc. from Flickr.")
+    parser_run_all.add_argument('--from_photostream', action='store_true', help="List the whole photostream once instead of asking about each photo.")
+    parser_run_all.add_argument('--excludes', type=str, help="A CSV file containing post IDs to ignore in the first field.")
+    parser_run_all.add_argument('--already_uploaded', type=str, default="already_uploaded.csv", help="A CSV file containing filenames and URLs on WP.")
+    parser_run_all.add_argument('--checkpoint', action='store_true', help="Write the catalogs out after each stage.")
+    parser_run_all.add_argument('--post_catalog', type=str, default="posts.json", help="Post catalog file for checkpoints, default '%(default)s'")
+    parser_run_all.add_argument('--image_catalog', type=str, default="images.json", help="Image catalog file for checkpoints, default '%(default)s'")
+    parser_run_all.set_defaults(func=run_all)
+
     args = parser.parse_args()
     args.func(args)
     